@@ -1,15 +1,18 @@
 import logging
 import os
-import subprocess
 import sys
 import asyncio
-import threading
+import codecs
+import hashlib
 import json
 import tempfile
+import orjson
+from collections import deque
 from contextlib import asynccontextmanager
-from fastapi import FastAPI
+from functools import lru_cache
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse, StreamingResponse
+from fastapi.responses import Response, StreamingResponse
 from pydantic import BaseModel
 import uvicorn
 
@@ -19,13 +22,22 @@ os.environ["GOOGLE_API_KEY"] = os.getenv("GOOGLE_API_KEY", "")
 from dotenv import load_dotenv
 load_dotenv(dotenv_path=".env.local")
 
-_loop: asyncio.AbstractEventLoop | None = None
+_index_html: bytes = b""
+_index_etag: str   = ""
 
 @asynccontextmanager
 async def _lifespan(app: FastAPI):
-    global _loop
-    _loop = asyncio.get_running_loop()
+    global _index_html, _index_etag
+    with open("index.html", "rb") as f:
+        _index_html = f.read()
+    _index_etag = '"' + hashlib.blake2b(_index_html, digest_size=8).hexdigest() + '"'
     yield
+    await stop_agent()
+    if reader_task and not reader_task.done():
+        reader_task.cancel()
+        await asyncio.wait({reader_task})
+    if _agent_file and os.path.exists(_agent_file):
+        os.remove(_agent_file)
 
 app = FastAPI(title="Voice Chatbot API", lifespan=_lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True,
@@ -34,64 +46,149 @@ app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True,
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("server")
 
-agent_process: subprocess.Popen | None = None
-log_buffer:      list[str]           = []
-log_subscribers: list[asyncio.Queue] = []
-tx_buffer:       list[dict]          = []
-tx_subscribers:  list[asyncio.Queue] = []
+agent_process: asyncio.subprocess.Process | None = None
+reader_task:   asyncio.Task | None               = None
+tx_buffer:     deque[bytes]                      = deque(maxlen=200)
+_agent_file: str | None = None   # private to this process, see start_agent()
+_last_code_hash: bytes | None = None
+_start_lock = asyncio.Lock()
 
+_PING     = b": ping\n\n"
+_DATA_PRE = b"data: "
+_NL       = b"\n\n"
+_EXITED_FRAME = b"data: agent process exited\n\n"
 
-def _fan_out(subscribers, payload):
-    if not _loop or _loop.is_closed():
+
+def _event_frame(ev: dict) -> bytes:
+    # Serialized once per event and shared by every /events/stream subscriber.
+    return _DATA_PRE + orjson.dumps(ev) + _NL
+
+
+_STOPPED_FRAME = _event_frame({"type": "state", "state": "stopped"})
+
+
+class Broadcast:
+    """Fixed-size ring of published messages read by any number of cursors.
+
+    Publishing is O(1) regardless of how many SSE clients are connected; each
+    client keeps its own cursor and a reader that falls more than `cap`
+    messages behind skips ahead to the oldest retained one.
+    """
+
+    def __init__(self, cap: int):
+        self.buf: list = [None] * cap
+        self.cap = cap
+        self.head = 0
+        self._ready: asyncio.Event | None = None
+
+    def publish(self, item):
+        self.buf[self.head % self.cap] = item
+        self.head += 1
+        if self._ready is not None:
+            self._ready.set()
+            self._ready = None
+
+    def read_from(self, cursor: int) -> tuple[list, int, int]:
+        """Return (items, new cursor, number of items the cursor missed)."""
+        missed = max(0, self.head - self.cap - cursor)
+        cursor += missed
+        items = [self.buf[i % self.cap] for i in range(cursor, self.head)]
+        return items, self.head, missed
+
+    async def wait(self, cursor: int):
+        if cursor != self.head:
+            return
+        # One Event shared by every reader waiting on the same head position.
+        if self._ready is None:
+            self._ready = asyncio.Event()
+        await self._ready.wait()
+
+
+log_channel = Broadcast(500)
+tx_channel  = Broadcast(200)
+_log_start  = 0   # log_channel.head when the current session started; replay begins here
+
+
+def _on_user(text: str, seen_user_texts: set[str]):
+    text = text.strip()
+    if text and text not in seen_user_texts:
+        seen_user_texts.add(text)
+        frame = _event_frame({"type": "transcript", "role": "user", "text": text})
+        tx_buffer.append(frame)
+        tx_channel.publish(frame)
+
+
+def _on_agent(text: str, seen_user_texts: set[str]):
+    text = text.strip()
+    if text:
+        frame = _event_frame({"type": "transcript", "role": "agent", "text": text})
+        tx_buffer.append(frame)
+        tx_channel.publish(frame)
+
+
+def _on_state(state: str, seen_user_texts: set[str]):
+    tx_channel.publish(_event_frame({"type": "state", "state": state.strip()}))
+
+
+# Two-letter tags the agent prints at the start of a line (see emit() calls).
+# emit() prefixes them with _TAG_MARK so ordinary output can never dispatch.
+_TAG_MARK = "\x1e"
+_HANDLERS = {"TU": _on_user, "TA": _on_agent, "AS": _on_state}
+
+
+def _handle_line(line: str, seen_user_texts: set[str]):
+    line = line.rstrip()
+    tagged = line.startswith(_TAG_MARK)
+    if tagged:
+        line = line[1:]
+    if not line:
         return
-    for q in list(subscribers):
-        try:
-            _loop.call_soon_threadsafe(q.put_nowait, payload)
-        except Exception:
-            pass
+    frame = _DATA_PRE + line.encode() + _NL
+    log_channel.publish(frame)
 
+    if tagged:
+        tag, _, rest = line.partition(" ")
+        handler = _HANDLERS.get(tag)
+        if handler:
+            handler(rest, seen_user_texts)
 
-def _reader_thread(proc: subprocess.Popen):
-    global log_buffer, tx_buffer
-    seen_user_texts = set()   # dedup user transcripts within a session
 
-    for raw in iter(proc.stdout.readline, ""):
-        line = raw.rstrip()
-        if not line:
-            continue
-        log_buffer.append(line)
-        if len(log_buffer) > 500:
-            log_buffer = log_buffer[-500:]
-        _fan_out(log_subscribers, line)
-
-        if "TRANSCRIPT_USER:" in line:
-            text = line.split("TRANSCRIPT_USER:", 1)[1].strip()
-            if text and text not in seen_user_texts:
-                seen_user_texts.add(text)
-                ev = {"type": "transcript", "role": "user", "text": text}
-                tx_buffer.append(ev)
-                _fan_out(tx_subscribers, ev)
-        elif "TRANSCRIPT_AGENT:" in line:
-            text = line.split("TRANSCRIPT_AGENT:", 1)[1].strip()
-            if text:
-                ev = {"type": "transcript", "role": "agent", "text": text}
-                tx_buffer.append(ev)
-                _fan_out(tx_subscribers, ev)
-        elif "AGENT_STATE:" in line:
-            state = line.split("AGENT_STATE:", 1)[1].strip()
-            _fan_out(tx_subscribers, {"type": "state", "state": state})
-
-    _fan_out(log_subscribers, None)
-    _fan_out(tx_subscribers, {"type": "state", "state": "stopped"})
+async def _reader_task(proc: asyncio.subprocess.Process):
+    seen_user_texts = set()   # dedup user transcripts within a session
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    pending: list[str] = []   # pieces of an unterminated line, joined once it ends
+
+    try:
+        while chunk := await proc.stdout.read(65536):
+            text = decoder.decode(chunk).replace("\r\n", "\n").replace("\r", "\n")
+            *lines, tail = text.split("\n")
+            if lines:
+                pending.append(lines[0])
+                lines[0] = "".join(pending)
+                pending.clear()
+                for line in lines:
+                    _handle_line(line, seen_user_texts)
+            if tail:
+                pending.append(tail)
+    finally:
+        # Also runs when cancelled by /start or on a reader error, so clients of
+        # this session always see the last output and the end markers.
+        pending.append(decoder.decode(b"", final=True))
+        _handle_line("".join(pending), seen_user_texts)
+        log_channel.publish(None)
+        tx_channel.publish(_STOPPED_FRAME)
 
 
 @app.get("/")
-async def root():
-    return FileResponse("index.html")
+async def root(request: Request):
+    headers = {"ETag": _index_etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == _index_etag:
+        return Response(status_code=304, headers=headers)
+    return Response(_index_html, media_type="text/html", headers=headers)
 
 @app.get("/status")
 async def get_status():
-    if agent_process and agent_process.poll() is None:
+    if agent_process and agent_process.returncode is None:
         return {"status": "running"}
     return {"status": "stopped"}
 
@@ -102,14 +199,11 @@ class AgentConfig(BaseModel):
     model: str = "gemini-2.5-flash-native-audio-preview-12-2025"
 
 
-def _build_agent_code(instructions, model, voice, api_key):
-    I = json.dumps(instructions)
-    M = json.dumps(model)
-    V = json.dumps(voice)
-    K = json.dumps(api_key)
-
-    return f"""import logging, os, asyncio, sys
-os.environ['GOOGLE_API_KEY'] = {K}
+# The agent runs as a separate `console` process rather than on this event loop:
+# livekit's cli.run_app owns its own loop, signal handlers and local audio I/O,
+# and a wedged session can always be terminated from /stop.
+_AGENT_TEMPLATE = """import logging, os, asyncio, sys
+os.environ['GOOGLE_API_KEY'] = %s
 from dotenv import load_dotenv
 load_dotenv(dotenv_path='.env.local')
 from livekit.agents import (
@@ -121,13 +215,15 @@ from livekit.plugins import google, noise_cancellation, silero
 logging.basicConfig(level=logging.INFO, stream=sys.stdout, force=True)
 logger = logging.getLogger('voice-chatbot')
 
-INSTRUCTIONS = {I}
-MODEL = {M}
-VOICE = {V}
+INSTRUCTIONS = %s
+MODEL = %s
+VOICE = %s
 
 
 def emit(line):
-    print(line, flush=True)
+    # Leading newline ends any unterminated console output so the tag starts a
+    # line; the \\x1e record separator marks it as ours for the server.
+    print('\\n\\x1e' + line, flush=True)
 
 
 class VoiceAssistant(Agent):
@@ -135,7 +231,7 @@ class VoiceAssistant(Agent):
         super().__init__(instructions=INSTRUCTIONS)
 
     async def on_enter(self):
-        emit('AGENT_STATE: active')
+        emit('AS active')
         await self.session.generate_reply(
             instructions='Greet the user warmly and tell them you are ready to chat.'
         )
@@ -171,9 +267,9 @@ async def entrypoint(ctx: JobContext):
             if not text:
                 return
             if role == 'user':
-                emit('TRANSCRIPT_USER: ' + text)
+                emit('TU ' + text)
             elif role in ('assistant', 'agent'):
-                emit('TRANSCRIPT_AGENT: ' + text)
+                emit('TA ' + text)
         except Exception as ex:
             logger.warning('item event error: ' + str(ex))
 
@@ -181,7 +277,7 @@ async def entrypoint(ctx: JobContext):
     def on_state(ev):
         try:
             s = str(ev.new_state).lower().split('.')[-1]
-            emit('AGENT_STATE: ' + s)
+            emit('AS ' + s)
         except Exception:
             pass
 
@@ -190,7 +286,7 @@ async def entrypoint(ctx: JobContext):
         agent=VoiceAssistant(),
         room_input_options=RoomInputOptions(noise_cancellation=noise_cancellation.BVC()),
     )
-    emit('AGENT_STATE: active')
+    emit('AS active')
     await asyncio.Event().wait()
 
 
@@ -207,56 +303,78 @@ if __name__ == '__main__':
 """
 
 
+@lru_cache(maxsize=8)
+def _build_agent_code(instructions, model, voice, api_key):
+    return _AGENT_TEMPLATE % (
+        json.dumps(api_key),
+        json.dumps(instructions),
+        json.dumps(model),
+        json.dumps(voice),
+    )
+
+
 @app.post("/start")
 async def start_agent(config: AgentConfig):
-    global agent_process, log_buffer, tx_buffer, log_subscribers, tx_subscribers
+    global agent_process, reader_task, _agent_file, _last_code_hash, _log_start
 
-    if agent_process and agent_process.poll() is None:
-        return {"message": "Agent already running", "status": "running"}
+    async with _start_lock:
+        if agent_process and agent_process.returncode is None:
+            return {"message": "Agent already running", "status": "running"}
 
-    log_buffer.clear()
-    tx_buffer.clear()
-    log_subscribers.clear()
-    tx_subscribers.clear()
+        # At most one reader: drop any task still draining a previous agent and
+        # let it publish its end markers before this session's output starts.
+        if reader_task and not reader_task.done():
+            reader_task.cancel()
+            await asyncio.wait({reader_task})
 
-    instructions = config.instructions or (
-        "You are a helpful and friendly AI voice assistant. "
-        "Listen carefully to what the user says and respond naturally."
-    )
+        _log_start = log_channel.head
+        tx_buffer.clear()
 
-    code = _build_agent_code(
-        instructions=instructions,
-        model=config.model,
-        voice=config.voice,
-        api_key=os.environ.get("GOOGLE_API_KEY", ""),
-    )
+        instructions = config.instructions or (
+            "You are a helpful and friendly AI voice assistant. "
+            "Listen carefully to what the user says and respond naturally."
+        )
 
-    agent_file = os.path.join(tempfile.gettempdir(), "_agent_runtime.py")
-    with open(agent_file, "w", encoding="utf-8") as f:
-        f.write(code)
+        code = _build_agent_code(
+            instructions=instructions,
+            model=config.model,
+            voice=config.voice,
+            api_key=os.environ.get("GOOGLE_API_KEY", ""),
+        )
 
-    agent_process = subprocess.Popen(
-        [sys.executable, "-u", agent_file, "console"],
-        stdout=subprocess.PIPE,
-        stderr=subprocess.STDOUT,
-        text=True,
-        bufsize=1,
-    )
+        # A unique, owner-only file per server process: nobody else can replace
+        # it between starts, so an unchanged hash really means unchanged code.
+        if _agent_file is None or not os.path.exists(_agent_file):
+            fd, _agent_file = tempfile.mkstemp(prefix="_agent_runtime_", suffix=".py")
+            os.close(fd)
+            _last_code_hash = None
+        code_hash = hashlib.blake2b(code.encode(), digest_size=16).digest()
+        if code_hash != _last_code_hash:
+            with open(_agent_file, "w", encoding="utf-8") as f:
+                f.write(code)
+            _last_code_hash = code_hash
+
+        agent_process = await asyncio.create_subprocess_exec(
+            sys.executable, "-u", _agent_file, "console",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT,
+        )
 
-    threading.Thread(target=_reader_thread, args=(agent_process,), daemon=True).start()
-    logger.info(f"Agent started — PID {agent_process.pid}")
-    return {"message": "Agent started", "status": "running", "pid": agent_process.pid}
+        reader_task = asyncio.create_task(_reader_task(agent_process))
+        logger.info(f"Agent started — PID {agent_process.pid}")
+        return {"message": "Agent started", "status": "running", "pid": agent_process.pid}
 
 
 @app.post("/stop")
 async def stop_agent():
     global agent_process
-    if agent_process and agent_process.poll() is None:
+    if agent_process and agent_process.returncode is None:
         agent_process.terminate()
         try:
-            await asyncio.wait_for(asyncio.to_thread(agent_process.wait), timeout=6)
+            await asyncio.wait_for(agent_process.wait(), timeout=6)
         except asyncio.TimeoutError:
             agent_process.kill()
+            await agent_process.wait()
         agent_process = None
         return {"message": "Agent stopped", "status": "stopped"}
     return {"message": "Agent was not running", "status": "stopped"}
@@ -264,25 +382,30 @@ async def stop_agent():
 
 @app.get("/logs/stream")
 async def stream_logs():
-    q: asyncio.Queue = asyncio.Queue(maxsize=500)
-    log_subscribers.append(q)
-
     async def generate():
-        for line in list(log_buffer):
-            yield f"data: {line}\n\n"
-        try:
-            while True:
-                try:
-                    line = await asyncio.wait_for(q.get(), timeout=25)
-                    if line is None:
-                        yield "data: agent process exited\n\n"
-                        break
-                    yield f"data: {line}\n\n"
-                except asyncio.TimeoutError:
-                    yield ": ping\n\n"
-        finally:
-            if q in log_subscribers:
-                log_subscribers.remove(q)
+        # Replay this session's history still held by the ring as one chunk. An
+        # end marker already in it belongs to a finished session: skip it and
+        # keep the stream open, so EventSource does not reconnect and replay
+        # again. Only a marker published after this point ends the stream.
+        history, cursor, _ = log_channel.read_from(
+            max(_log_start, log_channel.head - log_channel.cap))
+        backlog = b"".join(frame for frame in history if frame is not None)
+        if backlog:
+            yield backlog
+        while True:
+            try:
+                await asyncio.wait_for(log_channel.wait(cursor), timeout=25)
+            except asyncio.TimeoutError:
+                yield _PING
+                continue
+            frames, cursor, missed = log_channel.read_from(cursor)
+            if missed:
+                frames.insert(0, b"data: [%d log lines dropped]\n\n" % missed)
+            if None in frames:
+                end = frames.index(None)
+                yield b"".join(frames[:end]) + _EXITED_FRAME
+                return
+            yield b"".join(frames)
 
     return StreamingResponse(generate(), media_type="text/event-stream",
                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
@@ -290,24 +413,26 @@ async def stream_logs():
 
 @app.get("/events/stream")
 async def stream_events():
-    q: asyncio.Queue = asyncio.Queue(maxsize=200)
-    tx_subscribers.append(q)
-
     async def generate():
-        for ev in list(tx_buffer):
-            yield f"data: {json.dumps(ev)}\n\n"
-        try:
-            while True:
-                try:
-                    ev = await asyncio.wait_for(q.get(), timeout=25)
-                    yield f"data: {json.dumps(ev)}\n\n"
-                    if ev.get("type") == "state" and ev.get("state") == "stopped":
-                        break
-                except asyncio.TimeoutError:
-                    yield ": ping\n\n"
-        finally:
-            if q in tx_subscribers:
-                tx_subscribers.remove(q)
+        # Cursor and backlog are taken together, with no await in between, so a
+        # transcript published meanwhile is not sent twice.
+        cursor = tx_channel.head
+        backlog = b"".join(tx_buffer)
+        if backlog:
+            yield backlog
+        while True:
+            try:
+                await asyncio.wait_for(tx_channel.wait(cursor), timeout=25)
+            except asyncio.TimeoutError:
+                yield _PING
+                continue
+            frames, cursor, missed = tx_channel.read_from(cursor)
+            if missed:
+                frames.insert(0, _event_frame({"type": "dropped", "n": missed}))
+            if _STOPPED_FRAME in frames:
+                yield b"".join(frames[:frames.index(_STOPPED_FRAME) + 1])
+                return
+            yield b"".join(frames)
 
     return StreamingResponse(generate(), media_type="text/event-stream",
                              headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})